@@ -1,169 +1,342 @@
 from pathlib import Path
-from fastapi import FastAPI, APIRouter, HTTPException, Depends, Cookie, Response, status
-from fastapi.responses import JSONResponse, RedirectResponse
+from fastapi import FastAPI, APIRouter, BackgroundTasks, HTTPException, Depends, Cookie, Request, Response, status
+from fastapi.responses import ORJSONResponse, RedirectResponse
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from pydantic import BaseModel
+from pydantic import BaseModel, ConfigDict
 import uvicorn
 from dotenv import load_dotenv
 import os
-import requests
-import time
-import uuid
+import re
+import hashlib
+import struct
+import httpx
+import orjson
+import redis.asyncio as redis
+import secrets
+from functools import lru_cache
+from math import radians, sin, cos, asin, sqrt
+import numpy as np
 from twilio.rest import Client
 
-load_dotenv()
-
 # Configuration
-GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
-TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID")
-TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN")
-TWILIO_PHONE_NUMBER = os.getenv("TWILIO_PHONE_NUMBER", "")
-MY_PHONE_NUMBER = os.getenv("MY_PHONE_NUMBER", "")
-BABE_STEALER = os.getenv("BABE_STEALER", "")
+class Settings(BaseModel):
+    model_config = ConfigDict(frozen=True)
+    google_api_key: str | None
+    twilio_account_sid: str | None
+    twilio_auth_token: str | None
+    twilio_phone_number: str
+    my_phone_number: str
+    babe_stealer: str
+    redis_url: str
+    debug_distance: bool
+    allowed_origins: tuple[str, ...]
+
+# Cached factories: built once per process on first use, overridable in tests
+# via app.dependency_overrides
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    load_dotenv()
+    return Settings(
+        google_api_key=os.getenv("GOOGLE_API_KEY"),
+        twilio_account_sid=os.getenv("TWILIO_ACCOUNT_SID"),
+        twilio_auth_token=os.getenv("TWILIO_AUTH_TOKEN"),
+        twilio_phone_number=os.getenv("TWILIO_PHONE_NUMBER", ""),
+        my_phone_number=os.getenv("MY_PHONE_NUMBER", ""),
+        babe_stealer=os.getenv("BABE_STEALER", ""),
+        redis_url=os.getenv("REDIS_URL", "redis://localhost:6379/0"),
+        debug_distance=os.getenv("DEBUG_DISTANCE", "") == "1",
+        # Comma-separated list of browser origins allowed to call the API
+        allowed_origins=tuple(
+            origin.strip()
+            for origin in os.getenv("ALLOWED_ORIGINS", "http://localhost:8008").split(",")
+            if origin.strip()
+        ),
+    )
+
+@lru_cache(maxsize=1)
+def get_twilio() -> Client | None:
+    settings = get_settings()
+    if not (settings.twilio_account_sid and settings.twilio_auth_token):
+        return None
+    return Client(settings.twilio_account_sid, settings.twilio_auth_token)
 
 # Session Constants (in seconds)
 DEFAULT_TIMEOUT = 300      # 5 minutes
 SPECIAL_TIMEOUT = 7200     # 2 hours for "jollypolly"
+COORDS_TTL = SPECIAL_TIMEOUT  # tracking can't outlive the longest session
+
+# Proximity check
+EARTH_RADIUS_M = 6_371_008.8
+ALERT_RADIUS_M = 2000
+# Haversine term at exactly ALERT_RADIUS_M; asin and sqrt are monotonic, so
+# comparing the raw term against this is equivalent to comparing distances
+ALERT_THRESHOLD_A = sin(ALERT_RADIUS_M / (2 * EARTH_RADIUS_M)) ** 2
 
-# In-memory stores
-sessions = {} # {session_id: {"username": str, "expires_at": float}}
-last_set_destination_time = {} # {session_id: float}
+# Google Places cache lifetimes (in seconds)
+AUTOCOMPLETE_CACHE_TTL = 600      # 10 minutes
+PLACE_DETAILS_CACHE_TTL = 86400   # 24 hours
 
-if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN:
-    twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
-else:
-    twilio_client = None
+# Shared store keys (Redis), so every worker sees the same state
+#   sess:{session_id} -> username, expires via key TTL
+#   rl:{session_id}   -> set_destination rate limit marker
+#   dest:{username}   -> packed (lat, lng) doubles, expires via key TTL
+#   cur:{username}    -> packed (lat, lng) doubles, expires via key TTL
+#   ac:{sha1(input)}  -> cached autocomplete response body
+#   place:{place_id}  -> cached place location
 
-destination_coords: dict[str, float | None] = {"lat": None, "lng": None}
-current_coords: dict[str, float | None] = {"lat": None, "lng": None}
+Coords = tuple[float, float]  # (lat, lng) in degrees
+COORDS_FORMAT = struct.Struct("<2d")
 
 # --- Helper Functions ---
 
-def make_twilio_call():
-    if not twilio_client: return
+def make_twilio_call(twilio: Client | None, settings: Settings):
+    if not twilio: return
     try:
-        twilio_client.calls.create(
-            to=MY_PHONE_NUMBER,
-            from_=TWILIO_PHONE_NUMBER,
+        twilio.calls.create(
+            to=settings.my_phone_number,
+            from_=settings.twilio_phone_number,
             url="https://handler.twilio.com/twiml/EH717d0e56cd5b9578b06f3f7446f15a46"
         )
     except Exception as e:
         print(f"Twilio error: {e}")
 
-def compute_distance(coord1, coord2) -> bool:
-    if None in coord1.values() or None in coord2.values(): return False
-    from geopy.distance import geodesic
-    distance = geodesic((coord1['lat'], coord1['lng']), (coord2['lat'], coord2['lng'])).meters
-    return distance <= 2000
+def haversine_a(coord1: Coords, coord2: Coords) -> float:
+    lat1, lng1 = radians(coord1[0]), radians(coord1[1])
+    lat2, lng2 = radians(coord2[0]), radians(coord2[1])
+    return sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lng2 - lng1) / 2) ** 2
+
+def compute_distance_meters(coord1: Coords, coord2: Coords) -> float:
+    return 2 * EARTH_RADIUS_M * asin(sqrt(haversine_a(coord1, coord2)))
+
+def compute_distance(coord1: Coords | None, coord2: Coords | None) -> bool:
+    if coord1 is None or coord2 is None: return False
+    # Haversine is plenty accurate at a 2 km radius
+    return haversine_a(coord1, coord2) <= ALERT_THRESHOLD_A
+
+def compute_distance_bulk(lats: np.ndarray, lngs: np.ndarray, dest_lat: float, dest_lng: float) -> np.ndarray:
+    # Vectorized haversine: distances in meters from every ping to the destination
+    lat1, lng1 = np.radians(lats), np.radians(lngs)
+    lat2, lng2 = radians(dest_lat), radians(dest_lng)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(a))
 
-def verify_session(session_id: str = Cookie(None)):
-    if not session_id or session_id not in sessions:
+def encode_coords(coords: Coords) -> bytes:
+    return COORDS_FORMAT.pack(*coords)
+
+def decode_coords(raw: bytes | None) -> Coords | None:
+    return COORDS_FORMAT.unpack(raw) if raw else None
+
+async def verify_session(request: Request, session_id: str = Cookie(None)):
+    username = await request.app.state.cache.get(f"sess:{session_id}") if session_id else None
+    if username is None:
         raise HTTPException(status_code=401, detail="Session expired or invalid")
-    
-    session_data = sessions[session_id]
-    if time.time() > session_data["expires_at"]:
-        if session_id in sessions: del sessions[session_id]
-        raise HTTPException(status_code=401, detail="Session expired")
-    
-    return session_data["username"]
+    return username.decode()
+
+class CachedStaticFiles(StaticFiles):
+    # Fingerprinted assets (e.g. app.3f9a1c2e.js) never change under the same
+    # name; everything else, like home.html and login.html, is revalidated often
+    HASHED_NAME = re.compile(r"\.[0-9a-f]{8,}\.\w+$")
+
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if self.HASHED_NAME.search(str(full_path)):
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        else:
+            response.headers["Cache-Control"] = "public, max-age=60"
+        return response
 
 # --- Router & Endpoints ---
 
 router = APIRouter()
 
 class LoginRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
     username: str
     password: str
 
+class LocationRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+    location_name: str
+
+class DestinationRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+    place_id: str
+
+class LocationTrackingRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore", frozen=True)
+    latitude: float
+    longitude: float
+    timestamp: str | None = None
+
 @router.post("/login")
-def login(data: LoginRequest, response: Response):
+async def login(data: LoginRequest, request: Request, response: Response, settings: Settings = Depends(get_settings)):
     if len(data.username) < 5:
         raise HTTPException(status_code=400, detail="Username too short")
     if data.password != data.username[::-1]:
         raise HTTPException(status_code=401, detail="Invalid credentials")
     
-    session_id = str(uuid.uuid4())
-    timeout = SPECIAL_TIMEOUT if data.username == BABE_STEALER else DEFAULT_TIMEOUT
-    expires_at = time.time() + timeout
-    
-    sessions[session_id] = {"username": data.username, "expires_at": expires_at}
+    session_id = secrets.token_urlsafe(16)
+    timeout = SPECIAL_TIMEOUT if data.username == settings.babe_stealer else DEFAULT_TIMEOUT
+    await request.app.state.cache.set(f"sess:{session_id}", data.username, ex=timeout)
     response.set_cookie(key="session_id", value=session_id, httponly=True, samesite="lax")
     return {"status": "success", "username": data.username}
 
 @router.get("/session_info")
-def get_session_info(session_id: str = Cookie(None)):
-    if not session_id or session_id not in sessions:
+async def get_session_info(request: Request, session_id: str = Cookie(None)):
+    if not session_id:
         raise HTTPException(status_code=401)
-    session_data = sessions[session_id]
-    remaining = session_data["expires_at"] - time.time()
-    if remaining <= 0:
-        del sessions[session_id]
+    key = f"sess:{session_id}"
+    async with request.app.state.cache.pipeline(transaction=False) as pipe:
+        username, remaining_ms = await pipe.get(key).pttl(key).execute()
+    if username is None or remaining_ms <= 0:
         raise HTTPException(status_code=401)
-    return {"username": session_data["username"], "remaining_seconds": remaining}
+    return {"username": username.decode(), "remaining_seconds": remaining_ms / 1000}
 
 @router.post("/logout")
-def logout(response: Response, session_id: str = Cookie(None)):
-    if session_id in sessions: del sessions[session_id]
-    if session_id in last_set_destination_time: del last_set_destination_time[session_id]
+async def logout(request: Request, response: Response, session_id: str = Cookie(None)):
+    if session_id:
+        await request.app.state.cache.delete(f"sess:{session_id}", f"rl:{session_id}")
     response.delete_cookie("session_id")
     return {"status": "success"}
 
-@router.post("/set_destination")
-def set_destination(data: dict, session_id: str = Cookie(None), user: str = Depends(verify_session)):
+@router.post("/set_destination", response_model=None)
+async def set_destination(data: DestinationRequest, request: Request, session_id: str = Cookie(None), user: str = Depends(verify_session), settings: Settings = Depends(get_settings)):
     # 2nd Feature: Rate Limiting (1 request per second)
-    current_time = time.time()
-    last_time = last_set_destination_time.get(session_id, 0)
-    
-    if current_time - last_time < 1.0:
+    # SET NX with a 1s expiry only succeeds once per window, across all workers
+    if not await request.app.state.cache.set(f"rl:{session_id}", 1, px=1000, nx=True):
         raise HTTPException(
             status_code=status.HTTP_429_TOO_MANY_REQUESTS, 
             detail="Only one request per second is allowed."
         )
-    
-    last_set_destination_time[session_id] = current_time
 
     # Original destination logic
-    body = {"place_id": data.get("place_id"), "key": GOOGLE_API_KEY}
+    cache_key = f"place:{data.place_id}"
+    body = {"place_id": data.place_id, "key": settings.google_api_key}
     try:
-        res = requests.get("https://maps.googleapis.com/maps/api/place/details/json", params=body).json()
-        loc = res['result']['geometry']['location']
-        destination_coords.update({"lat": loc['lat'], "lng": loc['lng']})
-        return {"status": "success", "destination_coordinates": destination_coords}
+        if cached := await request.app.state.cache.get(cache_key):
+            loc = orjson.loads(cached)
+        else:
+            response = await request.app.state.http.get("https://maps.googleapis.com/maps/api/place/details/json", params=body)
+            res = orjson.loads(response.content)
+            loc = res['result']['geometry']['location']
+            await request.app.state.cache.set(cache_key, orjson.dumps(loc), ex=PLACE_DETAILS_CACHE_TTL)
+        await request.app.state.cache.set(f"dest:{user}", encode_coords((loc['lat'], loc['lng'])), ex=COORDS_TTL)
+        return {"status": "success", "destination_coordinates": {"lat": loc['lat'], "lng": loc['lng']}}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/autocomplete_location")
-def autocomplete_location(data: dict, user: str = Depends(verify_session)):
+@router.post("/autocomplete_location", response_model=None)
+async def autocomplete_location(data: LocationRequest, request: Request, user: str = Depends(verify_session), settings: Settings = Depends(get_settings)):
     # 1st Feature: Autocomplete Logic
+    cache_key = "ac:" + hashlib.sha1(data.location_name.encode()).hexdigest()
     body = {
-        "input": data.get("location_name"), 
+        "input": data.location_name, 
         "components": "country:in", 
-        "key": GOOGLE_API_KEY
+        "key": settings.google_api_key
     }
     try:
-        res = requests.get("https://maps.googleapis.com/maps/api/place/autocomplete/json", params=body).json()
+        if cached := await request.app.state.cache.get(cache_key):
+            return orjson.loads(cached)
+        response = await request.app.state.http.get("https://maps.googleapis.com/maps/api/place/autocomplete/json", params=body)
+        res = orjson.loads(response.content)
+        # Don't cache quota or key errors
+        if res.get("status") in ("OK", "ZERO_RESULTS"):
+            await request.app.state.cache.set(cache_key, response.content, ex=AUTOCOMPLETE_CACHE_TTL)
         return res
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
-@router.post("/track_location")
-def track_location(data: dict, user: str = Depends(verify_session)):
-    current_coords.update({"lat": data.get("latitude"), "lng": data.get("longitude")})
+@router.post("/track_location", response_model=None)
+async def track_location(
+    data: LocationTrackingRequest,
+    request: Request,
+    background_tasks: BackgroundTasks,
+    user: str = Depends(verify_session),
+    settings: Settings = Depends(get_settings),
+    twilio: Client | None = Depends(get_twilio),
+):
+    current_coords = (data.latitude, data.longitude)
+    async with request.app.state.cache.pipeline(transaction=False) as pipe:
+        _, raw_destination = await pipe.set(f"cur:{user}", encode_coords(current_coords), ex=COORDS_TTL).get(f"dest:{user}").execute()
+    destination_coords = decode_coords(raw_destination)
+    if settings.debug_distance and destination_coords is not None:
+        print(f"{user}: {compute_distance_meters(current_coords, destination_coords):.0f} m to destination")
     if compute_distance(current_coords, destination_coords):
-        make_twilio_call()
+        # Respond right away; the call is placed after the response is sent
+        background_tasks.add_task(make_twilio_call, twilio, settings)
         return {"status": "alert", "message": "Arrived! Calling now..."}
     return {"status": "success"}
 
-app = FastAPI()
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+@router.post("/track_location_batch", response_model=None)
+async def track_location_batch(
+    data: list[LocationTrackingRequest],
+    request: Request,
+    background_tasks: BackgroundTasks,
+    user: str = Depends(verify_session),
+    settings: Settings = Depends(get_settings),
+    twilio: Client | None = Depends(get_twilio),
+):
+    # Pings coalesced by the client while offline; one alert check for all of them
+    async with request.app.state.cache.pipeline(transaction=False) as pipe:
+        if data:
+            pipe.set(f"cur:{user}", encode_coords((data[-1].latitude, data[-1].longitude)), ex=COORDS_TTL)
+        pipe.get(f"dest:{user}")
+        *_, raw_destination = await pipe.execute()
+    destination_coords = decode_coords(raw_destination)
+    if not data or destination_coords is None:
+        return {"status": "success"}
+    lats = np.fromiter((p.latitude for p in data), dtype=np.float64, count=len(data))
+    lngs = np.fromiter((p.longitude for p in data), dtype=np.float64, count=len(data))
+    distances = compute_distance_bulk(lats, lngs, *destination_coords)
+    if (distances <= ALERT_RADIUS_M).any():
+        # Respond right away; the call is placed after the response is sent
+        background_tasks.add_task(make_twilio_call, twilio, settings)
+        return {"status": "alert", "message": "Arrived! Calling now..."}
+    return {"status": "success"}
+
+app = FastAPI(default_response_class=ORJSONResponse)
+
+@app.on_event("startup")
+async def startup():
+    app.state.cache = redis.from_url(get_settings().redis_url)
+    # Shared pool so Google API calls reuse TCP/TLS connections
+    app.state.http = httpx.AsyncClient(
+        timeout=5.0,
+        limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+    )
+
+@app.on_event("shutdown")
+async def shutdown():
+    await app.state.http.aclose()
+    await app.state.cache.aclose()
+
+app.add_middleware(GZipMiddleware, minimum_size=500)
+app.add_middleware(
+    CORSMiddleware,
+    allow_origins=list(get_settings().allowed_origins),
+    allow_credentials=True,
+    allow_methods=["GET", "POST"],
+    allow_headers=["content-type"],
+)
 BASE_DIR = Path(__file__).resolve().parent.parent
-app.mount("/static", StaticFiles(directory=BASE_DIR / "frontend"), name="static")
+app.mount("/static", CachedStaticFiles(directory=BASE_DIR / "frontend"), name="static")
 
 @app.get("/")
-def root(): return RedirectResponse(url="/static/login.html")
+async def root(): return RedirectResponse(url="/static/login.html")
 
 app.include_router(router, prefix="/api")
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8008)
\ No newline at end of file
+    uvicorn.run(
+        "app:app",
+        app_dir=str(Path(__file__).resolve().parent),
+        host="0.0.0.0",
+        port=8008,
+        loop="uvloop",
+        http="httptools",
+        workers=os.cpu_count(),
+        limit_concurrency=1000,
+        timeout_keep_alive=30,
+    )